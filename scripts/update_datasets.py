@@ -1,16 +1,22 @@
 import os
 import re
+import sys
+import csv
 import requests
-import xml.etree.ElementTree as ET
-from collections import defaultdict
-import pandas as pd
-import tempfile
+from lxml import etree as ET
+from openpyxl import load_workbook
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import json
 import datetime
+import concurrent.futures
+import multiprocessing
 
 # Directories
 DATA_PROCESSED_DIR = os.path.join("data", "processed")
 DATA_LATEST_DIR = os.path.join("data", "latest")
 INPUT_DIR = os.path.join("data", "input")
+CACHE_DIR = ".cache"
 VERSION_FILE = "version.txt"
 
 # Orphadata URLs
@@ -20,53 +26,156 @@ ORPHADATA_FILES = {
     "prevalence": "https://www.orphadata.com/data/xml/en_product9_prev.xml",
 }
 
+# Chunk size used when streaming downloads to disk
+DOWNLOAD_CHUNK_SIZE = 100 * 1024
+
+# Sent with every download; compressed transfers are decoded by iter_content
+DOWNLOAD_HEADERS = {"Accept-Encoding": "gzip, deflate"}
+
 # HGNC TSV URL
 HGNC_URL = "https://storage.googleapis.com/public-download-files/hgnc/tsv/tsv/hgnc_complete_set.txt"
 
+# Cell values treated as missing in the HGNC TSV; the same defaults as pandas.read_csv
+HGNC_NA_VALUES = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND",
+    "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+]
+
 # Excel input file containing Orphacodes column
 EXCEL_FILE = os.path.join(INPUT_DIR, "cnv_data.xlsx")
 
+# Precompiled XPath expressions used by the Orphadata parsers. The filtering
+# predicates run inside libxml2 instead of as nested Python loops.
+DEFINITION_XP = ET.XPath(
+    "SummaryInformationList/SummaryInformation[@lang='en']"
+    "/TextSectionList/TextSection[TextSectionType/Name[@lang='en']='Definition']"
+    "/Contents"
+)
+OMIM_REF_XP = ET.XPath(
+    "ExternalReferenceList/ExternalReference[Source='OMIM']/Reference/text()",
+    smart_strings=False,
+)
+HPO_ASSOC_XP = ET.XPath("HPODisorderAssociationList/HPODisorderAssociation")
+HPO_FREQUENCY_XP = ET.XPath("string(HPOFrequency/Name[@lang='en'])")
+WORLDWIDE_PREVALENCE_XP = ET.XPath(
+    "PrevalenceList/Prevalence"
+    "[PrevalenceGeographic/Name[@lang='en']='Worldwide']"
+    "[PrevalenceClass/Name[@lang='en']!='']"
+)
+PREVALENCE_CLASS_XP = ET.XPath("string(PrevalenceClass/Name[@lang='en'])", smart_strings=False)
+
+# Orphacodes in the Excel input: the leading digits of each comma-separated part
+ORPHACODE_PATTERN = re.compile(r"(?:^|,)\s*(\d+)")
+
+# PubMed IDs cited in prevalence sources, e.g. "12345[PMID]"
+PMID_PATTERN = re.compile(r'(\d+)\[PMID\]')
+
 def ensure_dirs():
     os.makedirs(DATA_PROCESSED_DIR, exist_ok=True)
     os.makedirs(DATA_LATEST_DIR, exist_ok=True)
     os.makedirs(INPUT_DIR, exist_ok=True)
+    os.makedirs(CACHE_DIR, exist_ok=True)
 
 # Extract orphacodes
 def load_orphacodes_from_excel():
-    df = pd.read_excel(EXCEL_FILE, engine='openpyxl')
+    # Read only the orphacodes column of the first sheet, streaming the rows
+    # in read-only mode rather than loading the whole workbook into pandas
+    workbook = load_workbook(EXCEL_FILE, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        column = next(rows).index("orphacodes")
+        entries = [row[column] for row in rows if column < len(row) and row[column] is not None]
+    finally:
+        workbook.close()
+
+    # Cells look like "739(deletion),72(deletion)"; one findall per cell pulls
+    # the leading digits of every comma-separated part
     orphacodes = set()
-    pattern = re.compile(r"^(\d+)") 
-
-    for entry in df['orphacodes'].dropna():
-        parts = [code.strip() for code in str(entry).split(",")]
-        for part in parts:
-            match = pattern.match(part)
-            if match:
-                orphacodes.add(match.group(1))
-    return orphacodes
+    for entry in entries:
+        orphacodes.update(map(sys.intern, ORPHACODE_PATTERN.findall(str(entry))))
+    # Immutable so it can be shared with the parser worker processes as-is
+    return frozenset(orphacodes)
+
+# Download helpers
+def create_download_session():
+    # One session for all downloads, so connections to each host are pooled
+    # and reused instead of opening a new TCP + TLS connection per file
+    session = requests.Session()
+    session.headers.update(DOWNLOAD_HEADERS)
+    return session
+
+def download_file(session, url, filename):
+    # Downloads are cached in CACHE_DIR with a .meta sidecar holding the
+    # ETag/Last-Modified, so unchanged files are not fetched again
+    out_path = os.path.join(CACHE_DIR, filename)
+    meta_path = out_path + ".meta"
+
+    headers = {}
+    if os.path.exists(out_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    # Stream to disk so the whole file is never held in memory
+    with session.get(url, headers=headers, stream=True) as r:
+        if r.status_code == 304:
+            print(f"{filename} is unchanged, using cached copy")
+            return out_path
+        r.raise_for_status()
+
+        # Write to a temporary name so an interrupted download never replaces the cached file
+        tmp_path = out_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+        os.replace(tmp_path, out_path)
+        meta = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+    return out_path
 
 # Orphadata parsing functions
-def parse_definitions(path, orphacodes):
-    root = ET.parse(path).getroot()
-    data = {}
-    for disorder in root.findall(".//Disorder"):
-        code = disorder.findtext("OrphaCode")
-        if code in orphacodes:
-            definition = ""
-            for summary_info in disorder.findall("SummaryInformationList/SummaryInformation"):
-                lang = summary_info.attrib.get("lang", "")
-                if lang == "en":
-                    for text_section in summary_info.findall("TextSectionList/TextSection"):
-                        section_type = text_section.find("TextSectionType/Name[@lang='en']")
-                        if section_type is not None and section_type.text == "Definition":
-                            contents = text_section.findtext("Contents")
-                            if contents:
-                                definition = contents.strip()
-                                break
-                if definition:
-                    break
-            data[code] = definition
-    return data
+def iter_disorders(path, orphacodes):
+    # Stream <Disorder> elements one at a time instead of loading the whole tree,
+    # yielding (code, disorder) only for the codes we keep
+    for _, disorder in ET.iterparse(path, events=("end",), tag="Disorder"):
+        code_elem = disorder.find("OrphaCode")
+        if code_elem is not None and code_elem.text in orphacodes:
+            yield code_elem.text, disorder
+
+        # Free the processed subtree along with any already-processed siblings
+        disorder.clear()
+        elem = disorder
+        while elem.getparent() is not None:
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+            elem = elem.getparent()
+
+def parse_definitions_and_omim(path, orphacodes):
+    # Definitions and OMIM references both come from en_product1.xml, so read it once
+    defs = {}
+    omim_map = {}
+    for code, disorder in iter_disorders(path, orphacodes):
+        # First non-empty English definition
+        definition = ""
+        for contents in DEFINITION_XP(disorder):
+            definition = (contents.text or "").strip()
+            if definition:
+                break
+        defs[code] = definition
+
+        refs = OMIM_REF_XP(disorder)
+        if refs:
+            if code in omim_map:
+                omim_map[code].extend(refs)
+            else:
+                # The XPath result is already a fresh list, so store it as-is
+                omim_map[code] = refs
+    return defs, omim_map
 
 
 def parse_phenotypes(path, orphacodes):
@@ -80,112 +189,110 @@ def parse_phenotypes(path, orphacodes):
         "Excluded (0%)": "excluded"
     }
 
-    root = ET.parse(path).getroot()
-    phenos = defaultdict(lambda: {"obligate": [], "very_frequent": [], "frequent": [], "occasional": [], "very_rare": [], "excluded": []})
-
-    for disorder in root.findall(".//Disorder"):
-        code = disorder.findtext("OrphaCode")
-        if code not in orphacodes:
-            continue
-
-        assoc_list = disorder.find("HPODisorderAssociationList")
-        if assoc_list is None:
-            continue
+    phenos = {}
 
-        for assoc in assoc_list.findall("HPODisorderAssociation"):
-            freq_name = assoc.findtext("HPOFrequency/Name[@lang='en']")
+    for code, disorder in iter_disorders(path, orphacodes):
+        # Only codes with phenotypes, and only the frequency categories they
+        # actually have, get an entry
+        categories = phenos.get(code)
+        for assoc in HPO_ASSOC_XP(disorder):
+            freq_name = HPO_FREQUENCY_XP(assoc)
             category = freq_map.get(freq_name)
             if category:
                 hpo_term = assoc.findtext("HPO/HPOTerm") or ""
                 hpo_id = assoc.findtext("HPO/HPOId") or ""
                 if hpo_term and hpo_id:
-                    phenos[code][category].append(f"{hpo_term} ({hpo_id})")
+                    phenotype = f"{hpo_term} ({hpo_id})"
+                    if categories is None:
+                        categories = phenos[code] = {}
+                    terms = categories.get(category)
+                    if terms is None:
+                        categories[category] = [phenotype]
+                    else:
+                        terms.append(phenotype)
 
     return phenos
 
 def parse_prevalence(path, orphacodes):
-    root = ET.parse(path).getroot()
     prevalence = {}
-    prevalence_source = defaultdict(list)
-    pmid_pattern = re.compile(r'(\d+)\[PMID\]')
+    prevalence_source = {}
 
-    for code in orphacodes:
-        disorder = root.find(f".//Disorder[OrphaCode='{code}']")
-        if disorder is None:
-            prevalence[code] = "Unknown"
+    for code, disorder in iter_disorders(path, orphacodes):
+        # Only the first Disorder entry of each code is used
+        if code in prevalence:
             continue
 
-        found_worldwide = False  # Track whether a valid entry was found
-
-        for prev in disorder.findall("PrevalenceList/Prevalence"):
-            geo = prev.findtext("PrevalenceGeographic/Name[@lang='en']")
-            class_ = prev.findtext("PrevalenceClass/Name[@lang='en']")
-            source_text = prev.findtext("Source") or ""
-
-            if geo != "Worldwide" or not class_:
-                continue
+        # Only the first Worldwide entry with a prevalence class is used
+        worldwide = WORLDWIDE_PREVALENCE_XP(disorder)
+        if not worldwide:
+            prevalence[code] = "Unknown"
+            continue
 
-            prevalence[code] = class_
-            found_worldwide = True
+        prev = worldwide[0]
+        prevalence[code] = PREVALENCE_CLASS_XP(prev)
 
-            pmids = pmid_pattern.findall(source_text)
-            prevalence_source[code].extend(pmids)
-            break  # stop after the first valid Worldwide entry
+        # Most sources cite no PMID, so skip the regex for those
+        source_text = prev.findtext("Source") or ""
+        if "[PMID]" in source_text:
+            prevalence_source[code] = PMID_PATTERN.findall(source_text)
 
-        if not found_worldwide:
-            prevalence[code] = "Unknown"
+    # Codes missing from the file have no known prevalence
+    for code in orphacodes:
+        prevalence.setdefault(code, "Unknown")
 
     return prevalence, prevalence_source
 
-def parse_omim(path, orphacodes):
-    root = ET.parse(path).getroot()
-    omim_map = defaultdict(list)
-    for disorder in root.findall(".//Disorder"):
-        code = disorder.findtext("OrphaCode")
-        if code not in orphacodes:
-            continue
-        ext_refs = disorder.find("ExternalReferenceList")
-        if ext_refs is None:
-            continue
-        for ext_ref in ext_refs.findall("ExternalReference"):
-            source = ext_ref.findtext("Source")
-            ref = ext_ref.findtext("Reference")
-            if source == "OMIM" and ref:
-                omim_map[code].append(ref)
-    return omim_map
-
 def save_combined_csv(defs, phenos, prevalence, prevalence_source, omims, orphacodes, output_path):
-    rows = []
-    for code in orphacodes:
-        phenotypes = phenos.get(code, {"obligate": [], "very_frequent": [], "frequent": [], "occasional": [], "very_rare": [], "excluded": []})
-        rows.append({
-            "OrphaCode": code,
-            "Definition": defs.get(code, ""),
-            "Phenotypes_Obligate(100%)": "; ".join(phenotypes["obligate"]),
-            "Phenotypes_Very_frequent(99-80%)": "; ".join(phenotypes["very_frequent"]),
-            "Phenotypes_Frequent(79-30%)": "; ".join(phenotypes["frequent"]),
-            "Phenotypes_Occasional(29-5%)": "; ".join(phenotypes["occasional"]),
-            "Phenotypes_Very_rare(<4-1%)": "; ".join(phenotypes["very_rare"]),
-            "Phenotypes_Excluded(0%)": "; ".join(phenotypes["excluded"]),
-            "Prevalence": prevalence.get(code, ""),
-            "Prevalence_pmid": ", ".join(prevalence_source.get(code, [])),
-            "OMIM": "; ".join(omims.get(code, []))
-        })
-    df = pd.DataFrame(rows)
-    df.to_csv(output_path, index=False)
+    header = [
+        "OrphaCode",
+        "Definition",
+        "Phenotypes_Obligate(100%)",
+        "Phenotypes_Very_frequent(99-80%)",
+        "Phenotypes_Frequent(79-30%)",
+        "Phenotypes_Occasional(29-5%)",
+        "Phenotypes_Very_rare(<4-1%)",
+        "Phenotypes_Excluded(0%)",
+        "Prevalence",
+        "Prevalence_pmid",
+        "OMIM",
+    ]
+    # Shared defaults for codes missing from a source, rather than new objects per row
+    empty = ()
+    no_phenotypes = {}
+
+    def rows():
+        # Numeric order keeps the output identical between runs
+        for code in sorted(orphacodes, key=int):
+            phenotypes = phenos.get(code, no_phenotypes)
+            yield (
+                code,
+                defs.get(code, ""),
+                "; ".join(phenotypes.get("obligate", empty)),
+                "; ".join(phenotypes.get("very_frequent", empty)),
+                "; ".join(phenotypes.get("frequent", empty)),
+                "; ".join(phenotypes.get("occasional", empty)),
+                "; ".join(phenotypes.get("very_rare", empty)),
+                "; ".join(phenotypes.get("excluded", empty)),
+                prevalence.get(code, ""),
+                ", ".join(prevalence_source.get(code, empty)),
+                "; ".join(omims.get(code, empty)),
+            )
+
+    # Write to a temporary file and swap it in, so a link to a same-day
+    # file never points at a partial file
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(header)
+        writer.writerows(rows())
+    os.replace(tmp_path, output_path)
 
 # HGNC download and processing
-def download_hgnc(tmpdir):
+def download_hgnc(session):
     print(f"Downloading HGNC file from {HGNC_URL}...")
-    r = requests.get(HGNC_URL)
-    r.raise_for_status()
-    hgnc_path = os.path.join(tmpdir, "hgnc_complete_set.txt")
-    with open(hgnc_path, "wb") as f:
-        f.write(r.content)
-    return hgnc_path
+    return download_file(session, HGNC_URL, "hgnc_complete_set.txt")
 
 def filter_hgnc(hgnc_path):
-    df = pd.read_csv(hgnc_path, sep="\t", dtype=str)
     columns_of_interest = [
         "hgnc_id",
         "symbol",
@@ -195,15 +302,45 @@ def filter_hgnc(hgnc_path):
         "uniprot_ids",
         "locus_group",
     ]
-    return df[columns_of_interest].copy()
+    # Only the columns of interest are parsed, all as strings, with the same
+    # missing-value markers pandas uses
+    table = pacsv.read_csv(
+        hgnc_path,
+        parse_options=pacsv.ParseOptions(delimiter="\t"),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=columns_of_interest,
+            column_types={column: pa.string() for column in columns_of_interest},
+            null_values=HGNC_NA_VALUES,
+            strings_can_be_null=True,
+        ),
+    )
+    return table.to_pandas()
 
 def save_hgnc(filtered_df, output_path):
-    filtered_df.to_csv(output_path, sep="\t", index=False)
+    # Write to a temporary file and swap it in, as in save_combined_csv
+    tmp_path = output_path + ".tmp"
+    filtered_df.to_csv(tmp_path, sep="\t", index=False)
+    os.replace(tmp_path, output_path)
 
 # Utility functions
+def parser_mp_context():
+    # Download threads are still running when the parser workers start, so
+    # this process must not fork them directly. A forkserver that has already
+    # imported this module forks them instead, sharing the loaded modules
+    # copy-on-write rather than re-importing them in every worker as spawn
+    # does. Windows only supports spawn.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__])
+        return context
+    return multiprocessing.get_context("spawn")
+
 def write_version_file(version):
-    with open(VERSION_FILE, "w") as f:
+    # Write to a temporary file and swap it in, so readers never see a partial file
+    tmp_path = VERSION_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
         f.write(version)
+    os.replace(tmp_path, VERSION_FILE)
 
 def update_symlink(src_path, symlink_dir):
     os.makedirs(symlink_dir, exist_ok=True)
@@ -216,21 +353,26 @@ def update_symlink(src_path, symlink_dir):
     # Compute relative path
     relative_src = os.path.relpath(src_path, symlink_dir)
 
-    if os.path.islink(symlink_path) or os.path.exists(symlink_path):
-        os.remove(symlink_path)
+    # Create the link under a temporary name and swap it in, so the path
+    # never goes missing while it is being updated
+    tmp_path = symlink_path + ".tmp"
+    if os.path.islink(tmp_path) or os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    os.symlink(relative_src, tmp_path)
+    os.replace(tmp_path, symlink_path)
 
-    os.symlink(relative_src, symlink_path)
-
-def clean_latest_dir():
+def clean_latest_dir(keep):
+    # Remove every link or file except the current ones listed in keep
     for filename in os.listdir(DATA_LATEST_DIR):
         path = os.path.join(DATA_LATEST_DIR, filename)
-        if os.path.islink(path) or os.path.isfile(path):
+        if filename not in keep and (os.path.islink(path) or os.path.isfile(path)):
             os.remove(path)
 
-def clean_processed_dir():
+def clean_processed_dir(keep):
+    # Remove every file except the current ones listed in keep
     for filename in os.listdir(DATA_PROCESSED_DIR):
         path = os.path.join(DATA_PROCESSED_DIR, filename)
-        if os.path.islink(path) or os.path.isfile(path):
+        if filename not in keep and (os.path.islink(path) or os.path.isfile(path)):
             os.remove(path)
 
 # Main 
@@ -238,35 +380,37 @@ def main():
     ensure_dirs()
     orphacodes = load_orphacodes_from_excel()
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        print(f"Using temporary directory: {tmpdir}")
+    parsers = {
+        "definitions": parse_definitions_and_omim,
+        "phenotypes": parse_phenotypes,
+        "prevalence": parse_prevalence,
+    }
 
-        # Download Orphadata files
+    # Download all files concurrently and parse each Orphadata file in a
+    # worker process as soon as it is on disk
+    with create_download_session() as session, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=4) as downloader, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=3, mp_context=parser_mp_context()) as parser_pool:
+        download_futures = {}
         for name, url in ORPHADATA_FILES.items():
-            out_path = os.path.join(tmpdir, f"{name}.xml")
             print(f"Downloading Orphadata {name}...")
-            r = requests.get(url)
-            r.raise_for_status()
-            with open(out_path, "wb") as f:
-                f.write(r.content)
+            download_futures[downloader.submit(download_file, session, url, f"{name}.xml")] = name
+        hgnc_future = downloader.submit(download_hgnc, session)
 
-        # Parse Orphadata files
-        def_path = os.path.join(tmpdir, "definitions.xml")
-        defs = parse_definitions(def_path, orphacodes)
-        omims = parse_omim(def_path, orphacodes)
-        phenos = parse_phenotypes(os.path.join(tmpdir, "phenotypes.xml"), orphacodes)
-        prevalence, prevalence_source = parse_prevalence(os.path.join(tmpdir, "prevalence.xml"), orphacodes)
+        parse_futures = {}
+        for future in concurrent.futures.as_completed(download_futures):
+            name = download_futures[future]
+            parse_futures[name] = parser_pool.submit(parsers[name], future.result(), orphacodes)
 
+        # Filter HGNC here while the workers are still parsing
+        filtered_hgnc = filter_hgnc(hgnc_future.result())
 
-        # Download and filter HGNC
-        hgnc_path = download_hgnc(tmpdir)
-        filtered_hgnc = filter_hgnc(hgnc_path)
+        defs, omims = parse_futures["definitions"].result()
+        phenos = parse_futures["phenotypes"].result()
+        prevalence, prevalence_source = parse_futures["prevalence"].result()
 
     today = datetime.datetime.now().strftime("%Y-%m-%d")
 
-    # Clean previous versions in the /processed folder
-    clean_processed_dir()
-
     # Save Orphadata processed CSV
     csv_path = os.path.join(DATA_PROCESSED_DIR, f"orphadata_filtered_{today}.csv")
     save_combined_csv(defs, phenos, prevalence, prevalence_source, omims, orphacodes, csv_path)
@@ -275,13 +419,15 @@ def main():
     hgnc_out_path = os.path.join(DATA_PROCESSED_DIR, f"hgnc_filtered_{today}.csv")
     save_hgnc(filtered_hgnc, hgnc_out_path)
 
-    # Clean previous versions in the /latest folder
-    clean_latest_dir()
-
     # Update latest symlinks
     update_symlink(csv_path, DATA_LATEST_DIR)
     update_symlink(hgnc_out_path, DATA_LATEST_DIR)
 
+    # Only now remove previous versions, links first so none is left dangling
+    current_files = {os.path.basename(csv_path), os.path.basename(hgnc_out_path)}
+    clean_latest_dir(keep=current_files)
+    clean_processed_dir(keep=current_files)
+
     # Save version
     write_version_file("v_" + today)
 